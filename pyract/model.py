@@ -16,6 +16,8 @@
 # along with Pyract.  If not, see <http://www.gnu.org/licenses/>.
 
 import json
+import weakref
+from contextlib import contextmanager
 from gi.repository import GObject
 from typing import Generic, Union, Dict, List
 
@@ -25,6 +27,18 @@ PopoType = Union[str, int, float, bool, dict, list]
 
 class Observable(GObject.GObject):
     changed_signal = GObject.Signal('changed')
+    _version = 0
+
+    def do_changed(self):
+        # The class closure runs before any connected handler, so they
+        # all see the new version
+        self._version += 1
+
+    @property
+    def version(self) -> int:
+        # Increases every time the changed signal is emitted, so "has this
+        # changed since I last looked" is an int comparison
+        return self._version
 
     def serialize(self) -> PopoType:
         raise NotImplimentedError()
@@ -33,10 +47,41 @@ class Observable(GObject.GObject):
         raise NotImplimentedError()
 
 
+def version_of(value):
+    return value.version if isinstance(value, Observable) else None
+
+
+# Equality strategies, used to decide if setting a value (or passing a prop)
+# is a change.  Any function taking (old, new) and returning a bool works.
+def equal_by_value(a, b):
+    return a == b
+
+
+def equal_by_identity(a, b):
+    return a is b
+
+
+def equal_by_version(a, b):
+    # Same object at the same version.  values_equal compares against the
+    # version that was seen when the old value was stored, so an Observable
+    # that changed since then is not equal to itself
+    return a is b and version_of(a) == version_of(b)
+
+
+def values_equal(equal, old, new, old_version=None) -> bool:
+    if equal is equal_by_version:
+        if old_version is None:
+            old_version = version_of(old)
+        return old is new and old_version == version_of(new)
+    return equal(old, new)
+
+
 class ObservableValue(Observable):
-    def __init__(self, value):
+    def __init__(self, value, equal=equal_by_value):
         super().__init__()
         self._value = value
+        self._value_version = version_of(value)
+        self._equal = equal
 
     @property
     def value(self):
@@ -44,9 +89,11 @@ class ObservableValue(Observable):
 
     @value.setter
     def value(self, new_value):
-        if self._value == new_value:
+        if values_equal(self._equal, self._value, new_value,
+                        self._value_version):
             return
         self._value = new_value
+        self._value_version = version_of(new_value)
         self.changed_signal.emit()
 
     def serialize(self) -> PopoType:
@@ -82,12 +129,13 @@ class ObservableModel(Observable):
                         'Can not replace observable key {} with '
                         'non-observable object {}'.format(k, new))
                 
+        super().__setattr__(k, new)
         if isinstance(new, Observable):
             new.changed_signal.connect(self._attribute_changed_cb)
 
+            # Emit after assigning, so listeners see the new field
             if old != new:
                 self.changed_signal.emit()
-        super().__setattr__(k, new)
 
     def serialize(self) -> Dict[str, PopoType]:
         ret = {}
@@ -96,6 +144,25 @@ class ObservableModel(Observable):
                 ret[k] = getattr(self, k).serialize()
         return ret
 
+    @contextmanager
+    def batch(self):
+        '''
+        Changes to the fields inside the block still notify the fields'
+        listeners, but the model only emits changed once, at the end
+        '''
+        fields = [getattr(self, k) for k, v in vars(type(self)).items()
+                  if isinstance(v, ModelField)]
+        versions = [f.version for f in fields]
+        for f in fields:
+            f.handler_block_by_func(self._attribute_changed_cb)
+        try:
+            yield
+        finally:
+            for f in fields:
+                f.handler_unblock_by_func(self._attribute_changed_cb)
+            if any(f.version != v for f, v in zip(fields, versions)):
+                self.changed_signal.emit()
+
     def serialize_to_path(self, path):
         j = self.serialize()
         with open(path, 'w') as f:
@@ -141,7 +208,7 @@ class ObservableList(ObservableValue):
     @value.setter
     def value(self, new_value):
         assert(isinstance(new_value, list))
-        if self._value == new_value:
+        if values_equal(self._equal, self._value, new_value):
             return
         for item in new_value:
             if item not in self._value:
@@ -149,6 +216,8 @@ class ObservableList(ObservableValue):
         for item in self._value:
             if item not in new_value:
                 item.disconnect_by_func(self._item_changed_cb)
+        self._value = new_value
+        self.changed_signal.emit()
 
     def __getitem__(self, y):  return self.value[y]
     def __iter__(self):  return iter(self.value)
@@ -186,3 +255,229 @@ class ObservableList(ObservableValue):
             ins = self._type()
             ins.deserialize(v)
             self.append(ins)
+
+
+class ObservableDict(Observable):
+    '''
+    A keyed collection of values.  Changing a key emits the `key-changed`
+    signal with that key, so listeners only need to look at the entry that
+    changed.  Use `watch(key)` to get an Observable for a single entry, which
+    can be passed as a prop to a Component.
+
+    If a type_ is given, the values should be Observables of that type.  They
+    are re-created through type_ when deserializing.
+    '''
+    key_changed_signal = GObject.Signal('key-changed', arg_types=(object,))
+
+    def __init__(self, type_=None, value=None, equal=equal_by_value):
+        super().__init__()
+        self._type = type_
+        self._equal = equal
+        self._value = {}
+        self._handlers = {}
+        self._key_observables = weakref.WeakValueDictionary()
+        for k, v in (value or {}).items():
+            self._value[k] = v
+            self._connect_item(k, v)
+
+    def _connect_item(self, key, item):
+        if isinstance(item, Observable):
+            self._handlers[key] = item.changed_signal.connect(
+                self._item_changed_cb, key)
+
+    def _disconnect_item(self, key):
+        handler = self._handlers.pop(key, None)
+        if handler is not None:
+            self._value[key].disconnect(handler)
+
+    def _item_changed_cb(self, item, key):
+        self._emit_key_changed(key)
+        self.changed_signal.emit()
+
+    def _emit_key_changed(self, key):
+        self.key_changed_signal.emit(key)
+        observable = self._key_observables.get(key)
+        if observable is not None:
+            observable.changed_signal.emit()
+
+    def _set(self, key, new_value):
+        # Returns True if the dict changed, so that callers can batch
+        # the changed signal
+        if key in self._value:
+            old = self._value[key]
+            if values_equal(self._equal, old, new_value):
+                return False
+            self._disconnect_item(key)
+        self._value[key] = new_value
+        self._connect_item(key, new_value)
+        self._emit_key_changed(key)
+        return True
+
+    def _remove(self, key):
+        self._disconnect_item(key)
+        item = self._value.pop(key)
+        self._emit_key_changed(key)
+        return item
+
+    @property
+    def value(self):
+        return self._value
+
+    @value.setter
+    def value(self, new_value):
+        assert(isinstance(new_value, dict))
+        changed = False
+        for k in [k for k in self._value if k not in new_value]:
+            self._remove(k)
+            changed = True
+        for k, v in new_value.items():
+            changed = self._set(k, v) or changed
+        if changed:
+            self.changed_signal.emit()
+
+    def __getitem__(self, key):  return self._value[key]
+    def __contains__(self, key):  return key in self._value
+    def __iter__(self):  return iter(self._value)
+    def __len__(self):  return len(self._value)
+    def __bool__(self):  return bool(self._value)
+
+    def __setitem__(self, key, value):
+        if self._set(key, value):
+            self.changed_signal.emit()
+
+    def __delitem__(self, key):
+        if key not in self._value:
+            raise KeyError(key)
+        self._remove(key)
+        self.changed_signal.emit()
+
+    def get(self, key, default=None):  return self._value.get(key, default)
+    def keys(self):  return self._value.keys()
+    def values(self):  return self._value.values()
+    def items(self):  return self._value.items()
+
+    def update(self, other=(), **kwargs):
+        '''
+        Set many keys at once.  `key-changed` is emitted for every key that
+        changed, but `changed` is only emitted once.
+        '''
+        if isinstance(other, dict):
+            other = other.items()
+        changed = False
+        for k, v in other:
+            changed = self._set(k, v) or changed
+        for k, v in kwargs.items():
+            changed = self._set(k, v) or changed
+        if changed:
+            self.changed_signal.emit()
+
+    def pop(self, key, *default):
+        if key not in self._value:
+            if default:
+                return default[0]
+            raise KeyError(key)
+        item = self._remove(key)
+        self.changed_signal.emit()
+        return item
+
+    def clear(self):
+        if not self._value:
+            return
+        for k in list(self._value):
+            self._remove(k)
+        self.changed_signal.emit()
+
+    def watch(self, key) -> 'ObservableDictKey':
+        '''
+        Returns an Observable that only changes when this key changes
+        '''
+        observable = self._key_observables.get(key)
+        if observable is None:
+            observable = ObservableDictKey(self, key)
+            self._key_observables[key] = observable
+        return observable
+
+    def _serialize_item(self, item) -> PopoType:
+        return item.serialize() if isinstance(item, Observable) else item
+
+    def _deserialize_item(self, value: PopoType):
+        if self._type is None:
+            return value
+        ins = self._type()
+        ins.deserialize(value)
+        return ins
+
+    def serialize(self) -> Dict[str, PopoType]:
+        return {k: self._serialize_item(v) for k, v in self._value.items()}
+
+    def deserialize(self, value: Dict[str, PopoType]):
+        # Reuses the existing entries, so unchanged keys stay quiet
+        self.deserialize_items(
+            value, removed=[k for k in self._value if k not in value])
+
+    def serialize_items(self, keys) -> Dict[str, PopoType]:
+        '''
+        Serialize only the given keys, skipping any that are not set
+        '''
+        return {k: self._serialize_item(self._value[k])
+                for k in keys if k in self._value}
+
+    def deserialize_items(self, value: Dict[str, PopoType], removed=()):
+        '''
+        Apply a partial serialized dict, as one batched change.  Existing
+        Observable values are deserialized in place, so keys whose value
+        did not change are left alone
+        '''
+        changed = False
+        for k in removed:
+            if k in self._value:
+                self._remove(k)
+                changed = True
+        for k, v in value.items():
+            old = self._value.get(k)
+            if self._type is not None and isinstance(old, self._type):
+                changed = self._deserialize_existing(k, old, v) or changed
+            else:
+                changed = self._set(k, self._deserialize_item(v)) or changed
+        if changed:
+            self.changed_signal.emit()
+
+    def _deserialize_existing(self, key, item, value: PopoType):
+        if item.serialize() == value:
+            return False
+        # Batch the item's own changed signals into one key-changed
+        version = item.version
+        item.handler_block_by_func(self._item_changed_cb)
+        try:
+            item.deserialize(value)
+        finally:
+            item.handler_unblock_by_func(self._item_changed_cb)
+        if item.version == version:
+            return False
+        self._emit_key_changed(key)
+        return True
+
+
+class ObservableDictKey(Observable):
+    '''
+    A single entry of an ObservableDict.  Only emits changed when that
+    entry is set, removed or (for Observable values) changes itself.
+    '''
+    def __init__(self, dict_: ObservableDict, key):
+        super().__init__()
+        self._dict = dict_
+        self.key = key
+
+    @property
+    def value(self):
+        return self._dict.get(self.key)
+
+    @value.setter
+    def value(self, new_value):
+        self._dict[self.key] = new_value
+
+    def serialize(self) -> PopoType:
+        return self._dict._serialize_item(self.value)
+
+    def deserialize(self, value: PopoType):
+        self.value = self._dict._deserialize_item(value)
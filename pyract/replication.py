@@ -0,0 +1,551 @@
+# Copyright 2017 Sam Parkinson <sam@sam.today>
+#
+# This file is part of Pyract.
+#
+# Pyract is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Pyract is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Pyract.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import socket
+import struct
+from gi.repository import GLib
+
+from .model import ObservableModel, ObservableDict, ModelField, PopoType
+
+
+# Frame kinds.  Every frame is [kind, seq, body]
+SNAPSHOT = 0  # body is the serialized model
+DELTA = 1     # body is a list of ops
+RESYNC = 2    # sent by a replica that missed a delta, body is None
+
+# Delta ops
+SET_FIELD = 0  # [SET_FIELD, name, serialized field]
+SET_KEYS = 1   # [SET_KEYS, name, {key: serialized value}, [removed keys]]
+
+# Frames announcing more than this are refused, so a bad peer can't make
+# us buffer up to 4 GiB.  Snapshots have to fit in it too
+MAX_FRAME_SIZE = 256 << 20
+
+_HEADER = struct.Struct('!I')
+_DOUBLE = struct.Struct('!d')
+_NONE, _TRUE, _FALSE, _INT, _FLOAT, _STR, _LIST, _DICT = b'NTFidslm'
+
+
+class ReplicationException(Exception):
+    pass
+
+
+def _write_varint(out: bytearray, n: int):
+    while n > 0x7f:
+        out.append((n & 0x7f) | 0x80)
+        n >>= 7
+    out.append(n)
+
+
+def _read_varint(data: bytes, pos: int):
+    n = 0
+    shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        n |= (byte & 0x7f) << shift
+        if not byte & 0x80:
+            return n, pos
+        shift += 7
+
+
+def _encode(out: bytearray, v):
+    if v is None:
+        out.append(_NONE)
+    elif v is True:
+        out.append(_TRUE)
+    elif v is False:
+        out.append(_FALSE)
+    elif isinstance(v, int):
+        out.append(_INT)
+        # Zigzag, so small negative numbers stay small
+        _write_varint(out, v << 1 if v >= 0 else (-v << 1) - 1)
+    elif isinstance(v, float):
+        out.append(_FLOAT)
+        out += _DOUBLE.pack(v)
+    elif isinstance(v, str):
+        b = v.encode('utf8')
+        out.append(_STR)
+        _write_varint(out, len(b))
+        out += b
+    elif isinstance(v, (list, tuple)):
+        out.append(_LIST)
+        _write_varint(out, len(v))
+        for item in v:
+            _encode(out, item)
+    elif isinstance(v, dict):
+        out.append(_DICT)
+        _write_varint(out, len(v))
+        for k, item in v.items():
+            _encode(out, k)
+            _encode(out, item)
+    else:
+        raise ReplicationException('Can not encode {!r}'.format(v))
+
+
+def _decode(data: bytes, pos: int):
+    tag = data[pos]
+    pos += 1
+    if tag == _NONE:
+        return None, pos
+    elif tag == _TRUE:
+        return True, pos
+    elif tag == _FALSE:
+        return False, pos
+    elif tag == _INT:
+        n, pos = _read_varint(data, pos)
+        return (n >> 1 if not n & 1 else -((n + 1) >> 1)), pos
+    elif tag == _FLOAT:
+        return _DOUBLE.unpack_from(data, pos)[0], pos + _DOUBLE.size
+    elif tag == _STR:
+        n, pos = _read_varint(data, pos)
+        return data[pos:pos + n].decode('utf8'), pos + n
+    elif tag == _LIST:
+        n, pos = _read_varint(data, pos)
+        ret = []
+        for _ in range(n):
+            item, pos = _decode(data, pos)
+            ret.append(item)
+        return ret, pos
+    elif tag == _DICT:
+        n, pos = _read_varint(data, pos)
+        ret = {}
+        for _ in range(n):
+            k, pos = _decode(data, pos)
+            ret[k], pos = _decode(data, pos)
+        return ret, pos
+    raise ReplicationException('Unknown tag {!r} at {}'.format(tag, pos - 1))
+
+
+def encode(value: PopoType) -> bytes:
+    out = bytearray()
+    _encode(out, value)
+    return bytes(out)
+
+
+def decode(data: bytes) -> PopoType:
+    value, pos = _decode(data, 0)
+    if pos != len(data):
+        raise ReplicationException(
+            'Trailing data after {} bytes'.format(pos))
+    return value
+
+
+def _frame(kind, seq, body) -> bytes:
+    payload = encode([kind, seq, body])
+    return _HEADER.pack(len(payload)) + payload
+
+
+def _decode_frame(payload: bytes):
+    try:
+        frame = decode(payload)
+    except (IndexError, struct.error, UnicodeDecodeError, TypeError) as e:
+        # TypeError is an unhashable dict key
+        raise ReplicationException('Malformed frame: {}'.format(e))
+    if not isinstance(frame, list) or len(frame) != 3 \
+       or not isinstance(frame[0], int) or not isinstance(frame[1], int):
+        raise ReplicationException('Malformed frame {!r}'.format(frame))
+    return frame
+
+
+class _Connection():
+    # A non-blocking framed socket, driven by the GLib main loop
+    def __init__(self, sock, frame_cb, closed_cb, drained_cb=None,
+                 max_frame=MAX_FRAME_SIZE):
+        self._sock = sock
+        self._max_frame = max_frame
+        self._sock.setblocking(False)
+        self._in = bytearray()
+        self._out = bytearray()
+        self._frame_cb = frame_cb
+        self._closed_cb = closed_cb
+        self._drained_cb = drained_cb
+        self._out_watch = None
+        # Running totals of bytes, so callers can tell which of their
+        # frames are still in the buffer
+        self.queued = 0
+        self.sent = 0
+        self._in_watch = GLib.io_add_watch(
+            sock.fileno(), GLib.PRIORITY_DEFAULT,
+            GLib.IO_IN | GLib.IO_HUP | GLib.IO_ERR, self._readable_cb)
+
+    @property
+    def buffered(self) -> int:
+        return len(self._out)
+
+    def send_frame(self, frame: bytes):
+        if self._sock is None:
+            return
+        self._out += frame
+        self.queued += len(frame)
+        if self._out_watch is None:
+            self._flush()
+
+    def _flush(self) -> bool:
+        # Returns True if there is still data waiting to be sent
+        while self._out:
+            try:
+                n = self._sock.send(self._out)
+            except BlockingIOError:
+                break
+            except OSError:
+                self.close()
+                return False
+            del self._out[:n]
+            self.sent += n
+
+        if self._out and self._out_watch is None:
+            self._out_watch = GLib.io_add_watch(
+                self._sock.fileno(), GLib.PRIORITY_DEFAULT,
+                GLib.IO_OUT, self._writable_cb)
+        return bool(self._out)
+
+    def _writable_cb(self, fd, condition):
+        if self._flush():
+            return True
+        self._out_watch = None
+        if self._sock is not None and self._drained_cb is not None:
+            self._drained_cb(self)
+        return False
+
+    def _readable_cb(self, fd, condition):
+        try:
+            data = self._sock.recv(65536)
+        except BlockingIOError:
+            return True
+        except OSError:
+            data = b''
+        if not data:
+            self._in_watch = None
+            self.close()
+            return False
+
+        self._in += data
+        while self._sock is not None and len(self._in) >= _HEADER.size:
+            length, = _HEADER.unpack_from(self._in)
+            if length > self._max_frame:
+                self._in_watch = None
+                self.close()
+                return False
+            end = _HEADER.size + length
+            if len(self._in) < end:
+                break
+            payload = bytes(self._in[_HEADER.size:end])
+            del self._in[:end]
+            try:
+                kind, seq, body = _decode_frame(payload)
+                self._frame_cb(self, kind, seq, body)
+            except ReplicationException:
+                # A peer speaking nonsense can't be trusted with later
+                # frames either, so drop it rather than break the main loop
+                self._in_watch = None
+                self.close()
+                return False
+        return self._sock is not None
+
+    def close(self):
+        if self._sock is None:
+            return
+        for watch in (self._in_watch, self._out_watch):
+            if watch is not None:
+                GLib.source_remove(watch)
+        self._in_watch = self._out_watch = None
+        self._in.clear()
+        self._out.clear()
+        self._sock.close()
+        self._sock = None
+        self._closed_cb(self)
+
+
+class _Replica():
+    def __init__(self):
+        # Waiting for a snapshot once its buffer drains
+        self.behind = False
+        # conn.queued just after the latest snapshot
+        self.snapshot_end = 0
+
+
+def _field_names(model: ObservableModel):
+    return [k for k, v in vars(type(model)).items()
+            if isinstance(v, ModelField)]
+
+
+def _remove_stale_socket(path):
+    # Left behind by a server that crashed.  If another server is still
+    # listening on it, leave it alone and let bind fail
+    if not os.path.exists(path):
+        return
+    probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        probe.connect(path)
+    except ConnectionRefusedError:
+        os.unlink(path)
+    except OSError:
+        pass
+    finally:
+        probe.close()
+
+
+class ReplicationServer():
+    '''
+    Publishes a model to the ReplicaClients connected to the Unix socket at
+    path.  Each replica gets a snapshot when it connects, then deltas of the
+    fields (or ObservableDict keys) that changed, coalesced per main loop
+    iteration.  A socket file left at path by a server that crashed is
+    removed.
+
+    If a replica reads slower than the model changes, and more than
+    max_buffer bytes are waiting for it, it stops getting deltas.  Once it
+    has caught up it gets a fresh snapshot instead.
+    '''
+    def __init__(self, model: ObservableModel, path: str,
+                 max_buffer=1 << 20):
+        self._model = model
+        self._path = path
+        self._max_buffer = max_buffer
+        self._seq = 0
+        # Maps connection -> _Replica
+        self._replicas = {}
+        self._fields = {}
+        self._dirty_fields = set()
+        self._dirty_keys = {}
+        self._flush_source = None
+
+        # Bind before connecting to the model, so a failed bind leaves the
+        # model untouched
+        _remove_stale_socket(path)
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            self._sock.bind(path)
+            self._sock.listen()
+        except OSError:
+            self._sock.close()
+            raise
+        self._sock.setblocking(False)
+
+        for name in _field_names(model):
+            self._watch_field(name)
+        model.changed_signal.connect(self._model_changed_cb)
+
+        self._accept_watch = GLib.io_add_watch(
+            self._sock.fileno(), GLib.PRIORITY_DEFAULT,
+            GLib.IO_IN, self._accept_cb)
+
+    def _watch_field(self, name):
+        field = getattr(self._model, name)
+        self._fields[name] = field
+        if isinstance(field, ObservableDict):
+            field.key_changed_signal.connect(self._key_changed_cb, name)
+        else:
+            field.changed_signal.connect(self._field_changed_cb, name)
+
+    def _unwatch_field(self, name):
+        field = self._fields.pop(name)
+        if isinstance(field, ObservableDict):
+            field.disconnect_by_func(self._key_changed_cb)
+        else:
+            field.disconnect_by_func(self._field_changed_cb)
+
+    def _model_changed_cb(self, model):
+        # Fields can be replaced with a new Observable
+        for name, field in list(self._fields.items()):
+            if getattr(model, name) is not field:
+                self._unwatch_field(name)
+                self._watch_field(name)
+                self._field_changed_cb(None, name)
+
+    def _field_changed_cb(self, field, name):
+        self._dirty_fields.add(name)
+        self._dirty_keys.pop(name, None)
+        self._schedule_flush()
+
+    def _key_changed_cb(self, dict_, key, name):
+        if name not in self._dirty_fields:
+            self._dirty_keys.setdefault(name, set()).add(key)
+        self._schedule_flush()
+
+    def _schedule_flush(self):
+        if self._flush_source is None:
+            self._flush_source = GLib.idle_add(self._flush_cb)
+
+    def _flush_cb(self):
+        self._flush_source = None
+        ops = []
+        for name in self._dirty_fields:
+            ops.append([SET_FIELD, name, self._fields[name].serialize()])
+        for name, keys in self._dirty_keys.items():
+            field = self._fields[name]
+            ops.append([SET_KEYS, name, field.serialize_items(keys),
+                        [k for k in keys if k not in field]])
+        self._dirty_fields.clear()
+        self._dirty_keys.clear()
+        if not ops:
+            return False
+
+        self._seq += 1
+        frame = _frame(DELTA, self._seq, ops)
+        for conn, replica in list(self._replicas.items()):
+            if replica.behind:
+                continue
+            conn.send_frame(frame)
+            # Sending can fail and close (and so forget) the connection.
+            # Only deltas count towards the limit, not the snapshot that
+            # may still be in front of them
+            if conn in self._replicas and conn.queued - max(
+                    conn.sent, replica.snapshot_end) > self._max_buffer:
+                replica.behind = True
+        return False
+
+    def _send_snapshot(self, conn):
+        replica = self._replicas.setdefault(conn, _Replica())
+        replica.behind = False
+        conn.send_frame(_frame(SNAPSHOT, self._seq, self._model.serialize()))
+        replica.snapshot_end = conn.queued
+
+    def _accept_cb(self, fd, condition):
+        try:
+            sock, _ = self._sock.accept()
+        except BlockingIOError:
+            return True
+        # Replicas only ever send tiny RESYNC frames
+        conn = _Connection(sock, self._frame_cb, self._closed_cb,
+                           self._drained_cb, max_frame=1024)
+        self._send_snapshot(conn)
+        return True
+
+    def _frame_cb(self, conn, kind, seq, body):
+        if kind != RESYNC:
+            raise ReplicationException(
+                'Unexpected frame kind {} from replica'.format(kind))
+        replica = self._replicas[conn]
+        if conn.sent < replica.snapshot_end:
+            # The snapshot still on its way will resync it
+            return
+        if conn.buffered:
+            # Send it once the queued deltas are out of the way
+            replica.behind = True
+        else:
+            self._send_snapshot(conn)
+
+    def _drained_cb(self, conn):
+        replica = self._replicas.get(conn)
+        if replica is not None and replica.behind:
+            self._send_snapshot(conn)
+
+    def _closed_cb(self, conn):
+        self._replicas.pop(conn, None)
+
+    def close(self):
+        GLib.source_remove(self._accept_watch)
+        if self._flush_source is not None:
+            GLib.source_remove(self._flush_source)
+            self._flush_source = None
+        for conn in list(self._replicas):
+            conn.close()
+        for name in list(self._fields):
+            self._unwatch_field(name)
+        self._model.disconnect_by_func(self._model_changed_cb)
+        self._sock.close()
+        os.unlink(self._path)
+
+
+class ReplicaClient():
+    '''
+    Keeps a model in sync with the ReplicationServer at path.  Each frame
+    from the server is applied as one batch, so the model only emits
+    changed once per frame.
+
+    The replica should be treated as read only; local changes are not sent
+    to the server, and are overwritten on the next resync.
+    '''
+    def __init__(self, model: ObservableModel, path: str,
+                 max_frame=MAX_FRAME_SIZE):
+        self._model = model
+        self._seq = None
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(path)
+        self._conn = _Connection(sock, self._frame_cb, self._closed_cb,
+                                 max_frame=max_frame)
+        self.connected = True
+
+    def _frame_cb(self, conn, kind, seq, body):
+        if kind == SNAPSHOT:
+            if not isinstance(body, dict):
+                raise ReplicationException('Malformed snapshot')
+            self._seq = seq
+            self._apply(self._snapshot_ops(body))
+        elif kind == DELTA:
+            if not isinstance(body, list):
+                raise ReplicationException('Malformed delta')
+            if self._seq is None or seq <= self._seq:
+                # Waiting for a snapshot, or already included in it
+                return
+            if seq != self._seq + 1:
+                self._seq = None
+                conn.send_frame(_frame(RESYNC, 0, None))
+                return
+            self._seq = seq
+            self._apply(body)
+        else:
+            raise ReplicationException(
+                'Unexpected frame kind {} from server'.format(kind))
+
+    def _snapshot_ops(self, body):
+        for name, value in body.items():
+            field = getattr(self._model, name, None)
+            if isinstance(field, ObservableDict) and isinstance(value, dict):
+                # Only touches the keys that differ, see deserialize_items
+                yield [SET_KEYS, name, value,
+                       [k for k in field if k not in value]]
+            else:
+                yield [SET_FIELD, name, value]
+
+    def _apply(self, ops):
+        fields = _field_names(self._model)
+        with self._model.batch():
+            for op in ops:
+                self._apply_op(fields, op)
+
+    def _apply_op(self, fields, op):
+        if not isinstance(op, list) or len(op) < 3 or op[1] not in fields:
+            raise ReplicationException('Malformed delta op {!r}'.format(op))
+        field = getattr(self._model, op[1])
+        if op[0] == SET_KEYS:
+            if len(op) != 4 or not isinstance(field, ObservableDict) \
+               or not isinstance(op[2], dict) or not isinstance(op[3], list):
+                raise ReplicationException(
+                    'Malformed delta op {!r}'.format(op))
+        elif op[0] != SET_FIELD:
+            raise ReplicationException('Unknown delta op {!r}'.format(op[0]))
+
+        # The server's model may not match ours, eg. a different version of
+        # the app, so any error deserializing is a protocol error
+        try:
+            if op[0] == SET_FIELD:
+                field.deserialize(op[2])
+            else:
+                field.deserialize_items(op[2], op[3])
+        except Exception as e:
+            raise ReplicationException(
+                'Can not apply {!r} to {}: {}'.format(op[0], op[1], e)) from e
+
+    def _closed_cb(self, conn):
+        self.connected = False
+
+    def close(self):
+        self._conn.close()
@@ -19,7 +19,8 @@ import sys
 from gi.repository import Gtk, Gdk, GObject
 from typing import Union, List
 
-from .model import Observable
+from .model import (Observable, values_equal, version_of, equal_by_value,
+                    equal_by_version)
 
 
 class Node(tuple):
@@ -31,6 +32,8 @@ class Node(tuple):
         self.props = props
         # Almost a tuple, but we have this nice mutable instance prop
         self.instance = None
+        # Versions of the Observable props when this node was rendered
+        self.versions = {}
 
     def __repr__(self):
         return '<Node<{}.{}> {} {}>'.format(
@@ -261,25 +264,98 @@ class GtkComponent(BaseComponent):
 
 
 
+# The Providers above the component currently being rendered, keyed by
+# Context.  Components take a copy of this when they are created.
+_current_contexts = {}
+
+
 class Component(BaseComponent):
+    # Maps prop names to equality strategies (see pyract.model), used when
+    # diffing this component's props.  Defaults to prop_values_equal
+    prop_equality = {}
+    # Maps names to Select(context, selector).  The selected values are
+    # passed to render along with the props.  Context changes only
+    # re-render the component when one of its selected values changes
+    contexts = {}
+
     def __init__(self, **props):
         super().__init__()
         self.props = {}
         self.state = None
         self._rendered_yet = False
+        self._rendered_versions = {}
+        self._contexts = _current_contexts
+        self._selected = {}
+        self._selector_memo = {}
 
         self._subtreelist = None
         self.update(props.items())
 
     def _observable_changed_cb(self, observable):
+        # Our parent may have already re-rendered us for this change, by
+        # passing the Observable again (eg. with equal_by_version)
+        if observable.version == self._rendered_versions.get(observable):
+            return
         self.update()
 
+    def _context_changed(self):
+        if self._select_contexts():
+            self.update()
+
+    def _select_contexts(self) -> bool:
+        # Returns True if any selected value changed
+        changed = False
+        for name, select in type(self).contexts.items():
+            provider = self._contexts.get(select.context)
+            value = (provider.value if provider is not None
+                     else select.context.default)
+
+            # The selector only needs to run again if the context value
+            # has changed since it last ran
+            memo = self._selector_memo.get(name)
+            if memo is not None and values_equal(
+                    equal_by_version, memo[0], value, memo[1]):
+                continue
+            self._selector_memo[name] = (value, version_of(value))
+
+            new = select.selector(value)
+            if name in self._selected:
+                old = self._selected[name]
+                if values_equal(select.equal, old, new):
+                    continue
+                if isinstance(old, Observable):
+                    old.disconnect_by_func(self._observable_changed_cb)
+            if isinstance(new, Observable):
+                new.changed_signal.connect(self._observable_changed_cb)
+            self._selected[name] = new
+            changed = True
+        return changed
+
+    def _child_contexts(self):
+        return self._contexts
+
+    def _render_props(self):
+        for name in type(self).contexts:
+            if name in self.props:
+                raise RenderException(
+                    'Context {} of {} has the same name as a prop'.format(
+                        name, type(self)))
+        return dict(self.props, **self._selected)
+
     def update(self, updated_list=[]):
+        stale = not updated_list
         for k, v in updated_list:
             if k.startswith('child__'):
                 continue  # We don't handle the child props ourself
 
             old = self.props.get(k)
+            if old is v and isinstance(v, Observable):
+                # Passed again as it changed (eg. equal_by_version), but we
+                # are already connected so have probably rendered it
+                stale = stale or v.version != self._rendered_versions.get(v)
+                continue
+            stale = True
+
             if isinstance(old, Observable):
                 old.disconnect_by_func(self._observable_changed_cb)
 
@@ -287,17 +363,39 @@ class Component(BaseComponent):
             if isinstance(v, Observable):
                 v.changed_signal.connect(self._observable_changed_cb)
 
+        if self._rendered_yet and not stale:
+            return
+
         if not self._rendered_yet:
             if hasattr(type(self), 'State'):
                 state_cls = getattr(type(self), 'State')
                 self.state = state_cls()
-            self.before_first_render(**self.props)
+            for select in type(self).contexts.values():
+                provider = self._contexts.get(select.context)
+                if provider is not None:
+                    provider.subscribe(self)
+            self._select_contexts()
+            self.before_first_render(**self._render_props())
             if self.state is not None:
                 self.state.changed_signal.connect(self._observable_changed_cb)
             self._rendered_yet = True
 
-        new = self.render(**self.props)
-        self._subtreelist = render_treelist(self._subtreelist, new)
+        self._select_contexts()
+        # Versions of every Observable this render depends on
+        self._rendered_versions = {
+            v: v.version
+            for v in [*self.props.values(), *self._selected.values(),
+                      self.state]
+            if isinstance(v, Observable)}
+
+        global _current_contexts
+        parent_contexts = _current_contexts
+        _current_contexts = self._child_contexts()
+        try:
+            new = self.render(**self._render_props())
+            self._subtreelist = render_treelist(self._subtreelist, new)
+        finally:
+            _current_contexts = parent_contexts
         self.updated_signal.emit()
 
     def before_first_render(self, **props) -> None:
@@ -319,10 +417,81 @@ class Component(BaseComponent):
         return widgets
 
     def destroy(self):
+        for select in type(self).contexts.values():
+            provider = self._contexts.get(select.context)
+            if provider is not None:
+                provider.unsubscribe(self)
         for node in self._get_subtreelist():
             node.instance.destroy()
 
 
+class Context():
+    def __init__(self, default=None):
+        self.default = default
+
+
+class Select():
+    def __init__(self, context: Context, selector, equal=equal_by_value):
+        self.context = context
+        self.selector = selector
+        self.equal = equal
+
+
+class Provider(Component):
+    '''
+    Makes a value available to every Component below it, eg:
+
+        Node(Provider, context=SettingsContext, value=settings,
+             child=Node(AppComponent))
+
+    Components read it by declaring `contexts`, so the value does not need
+    to be passed through the props of every component in between.  The
+    Provider does not re-render when the value changes; it only tells the
+    components that selected from it.
+    '''
+    def __init__(self, **props):
+        self._consumers = {}
+        super().__init__(**props)
+
+    @property
+    def value(self):
+        return self.props.get('value')
+
+    def subscribe(self, component: Component):
+        self._consumers[component] = True
+
+    def unsubscribe(self, component: Component):
+        self._consumers.pop(component, None)
+
+    def _child_contexts(self):
+        contexts = dict(self._contexts)
+        contexts[self.props['context']] = self
+        return contexts
+
+    def _observable_changed_cb(self, observable):
+        if observable is self.value:
+            self._notify_consumers()
+        else:
+            super()._observable_changed_cb(observable)
+
+    def _notify_consumers(self):
+        # Consumers subscribe as they are first rendered, so parents are
+        # told before their children.  A parent re-rendering can destroy
+        # (and so unsubscribe) a child that is still in our copy
+        for component in list(self._consumers):
+            if component in self._consumers:
+                component._context_changed()
+
+    def update(self, updated_list=[]):
+        old = self.value
+        super().update(updated_list)
+        if self.value is not old:
+            self._notify_consumers()
+
+    def render(self, child=None, **props):
+        return child or []
+
+
 def treeitem_to_key(i, v):
     type, props = v
     return '{}:{}.{}'.format(
@@ -359,6 +528,7 @@ def render_tree(old, new):
     # Split the tree input
     old_type, old_props = old or (None, {})
     instance = old.instance if old else None
+    old_versions = old.versions if old else {}
     new_type, new_props = new
 
     to_inflate = _get_to_inflate_for_type(new_type)
@@ -370,6 +540,7 @@ def render_tree(old, new):
             new_props[k] = v
 
     if old_type == new_type:
+        prop_equality = getattr(new_type, 'prop_equality', {})
         changes = []
         for k in old_props.keys():
             if k in _EXCLUDED_KEYS:
@@ -379,7 +550,9 @@ def render_tree(old, new):
         for k, v in new_props.items():
             if k in _EXCLUDED_KEYS:
                 continue
-            if not prop_values_equal(old_props.get(k), v):
+            equal = prop_equality.get(k, prop_values_equal)
+            if not values_equal(equal, old_props.get(k), v,
+                                old_versions.get(k)):
                 changes.append((k, v))
         if changes:
             instance.update(changes)
@@ -398,6 +571,8 @@ def render_tree(old, new):
 
     node = Node(new_type, **new_props)
     node.instance = instance
+    node.versions = {k: v.version for k, v in new_props.items()
+                     if isinstance(v, Observable)}
     return node
 
 
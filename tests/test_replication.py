@@ -0,0 +1,151 @@
+# Copyright 2017 Sam Parkinson <sam@sam.today>
+#
+# This file is part of Pyract.
+#
+# Pyract is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Pyract is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Pyract.  If not, see <http://www.gnu.org/licenses/>.
+
+import unittest
+
+from pyract import replication as r
+from pyract.model import (ObservableModel, ObservableValue, ObservableDict,
+                          ModelField)
+
+
+class _Model(ObservableModel):
+    count = ModelField(ObservableValue, 0)
+    items = ModelField(ObservableDict)
+
+
+class _FakeConnection():
+    def __init__(self):
+        self.frames = []
+
+    def send_frame(self, frame):
+        self.frames.append(r._decode_frame(frame[r._HEADER.size:]))
+
+
+def _replica(model):
+    # A ReplicaClient without a socket, to feed frames to directly
+    client = r.ReplicaClient.__new__(r.ReplicaClient)
+    client._model = model
+    client._seq = None
+    return client
+
+
+class EncodingTest(unittest.TestCase):
+    def test_round_trip(self):
+        for value in [None, True, False, 0, 1, -1, -2, 63, -64, 2 ** 64,
+                      -2 ** 70, 1.5, -0.25, '', 'héllo', [], {},
+                      [1, [2, [3]]], {'a': {'b': [1, {'c': None}]}, 5: -5}]:
+            with self.subTest(value=value):
+                self.assertEqual(r.decode(r.encode(value)), value)
+
+    def test_small_ints_are_small(self):
+        self.assertEqual(len(r.encode(-1)), 2)
+        self.assertEqual(len(r.encode(63)), 2)
+
+    def test_encode_rejects_unknown_types(self):
+        with self.assertRaises(r.ReplicationException):
+            r.encode(object())
+
+
+class DecodeFrameTest(unittest.TestCase):
+    def test_valid(self):
+        frame = r._frame(r.DELTA, 3, [[r.SET_FIELD, 'count', 1]])
+        self.assertEqual(r._decode_frame(frame[r._HEADER.size:]),
+                         [r.DELTA, 3, [[r.SET_FIELD, 'count', 1]]])
+
+    def test_malformed(self):
+        for payload in [
+                b'',                                  # empty
+                r.encode([r.DELTA, 1, 'body'])[:-2],  # truncated
+                b'?',                                 # unknown tag
+                r.encode(None) + b'N',                # trailing data
+                b'i\x80',                             # unterminated varint
+                b's\x02\xff\xfe',                     # bad utf8
+                b'm\x01l\x00N',                       # unhashable key
+                r.encode([r.DELTA, 1]),               # wrong length
+                r.encode({'kind': r.DELTA}),          # not a list
+                r.encode(['1', 1, None]),             # kind not an int
+        ]:
+            with self.subTest(payload=payload):
+                with self.assertRaises(r.ReplicationException):
+                    r._decode_frame(payload)
+
+
+class ReplicaClientTest(unittest.TestCase):
+    def setUp(self):
+        self.model = _Model()
+        self.client = _replica(self.model)
+        self.conn = _FakeConnection()
+        self.client._frame_cb(self.conn, r.SNAPSHOT, 5,
+                              {'count': 1, 'items': {'a': 1}})
+
+    def test_snapshot(self):
+        self.assertEqual(self.model.count.value, 1)
+        self.assertEqual(self.model.items.value, {'a': 1})
+
+    def test_deltas_in_order(self):
+        self.client._frame_cb(self.conn, r.DELTA, 6,
+                              [[r.SET_FIELD, 'count', 2]])
+        self.client._frame_cb(self.conn, r.DELTA, 7,
+                              [[r.SET_KEYS, 'items', {'b': 2}, ['a']]])
+        self.assertEqual(self.model.count.value, 2)
+        self.assertEqual(self.model.items.value, {'b': 2})
+        self.assertEqual(self.conn.frames, [])
+
+    def test_old_deltas_are_ignored(self):
+        self.client._frame_cb(self.conn, r.DELTA, 5,
+                              [[r.SET_FIELD, 'count', 100]])
+        self.assertEqual(self.model.count.value, 1)
+
+    def test_gap_requests_resync(self):
+        self.client._frame_cb(self.conn, r.DELTA, 7,
+                              [[r.SET_FIELD, 'count', 2]])
+        self.assertEqual(self.model.count.value, 1)
+        self.assertEqual(self.conn.frames, [[r.RESYNC, 0, None]])
+
+        # Nothing more is applied until the next snapshot
+        self.client._frame_cb(self.conn, r.DELTA, 8,
+                              [[r.SET_FIELD, 'count', 3]])
+        self.assertEqual(self.model.count.value, 1)
+        self.client._frame_cb(self.conn, r.SNAPSHOT, 8,
+                              {'count': 3, 'items': {}})
+        self.client._frame_cb(self.conn, r.DELTA, 9,
+                              [[r.SET_FIELD, 'count', 4]])
+        self.assertEqual(self.model.count.value, 4)
+        self.assertEqual(self.model.items.value, {})
+
+    def test_batched_notification(self):
+        changes = []
+        self.model.changed_signal.connect(lambda m: changes.append(m))
+        self.client._frame_cb(self.conn, r.DELTA, 6, [
+            [r.SET_FIELD, 'count', 2],
+            [r.SET_KEYS, 'items', {'b': 2, 'c': 3}, []]])
+        self.assertEqual(len(changes), 1)
+
+    def test_bad_ops(self):
+        for op in [[r.SET_FIELD, 'missing', 1],
+                   [r.SET_KEYS, 'items', 5, []],
+                   [r.SET_KEYS, 'count', {}, []],
+                   [r.SET_FIELD, 'items', 5],
+                   [99, 'count', 1]]:
+            with self.subTest(op=op):
+                with self.assertRaises(r.ReplicationException):
+                    self.client._frame_cb(self.conn, r.DELTA,
+                                          self.client._seq + 1, [op])
+
+
+if __name__ == '__main__':
+    unittest.main()